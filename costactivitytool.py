@@ -2,6 +2,8 @@
 from ZODB import DB
 from ZODB.FileStorage import FileStorage
 from ZODB.PersistentMapping import PersistentMapping
+from ZODB.POSException import ConflictError
+from ZODB.utils import p64, u64, z64, get_pickle_metadata
 import transaction
 
 # Imports needed for Persistent classes:
@@ -11,19 +13,127 @@ import transaction
 from persistent import Persistent
 from persistent.dict import PersistentDict
 from persistent.list import PersistentList
+from persistent.TimeStamp import TimeStamp
+# BTrees are used for the catalogues as they resolve the conflicts between
+# concurrent inserts of different codes.
+from BTrees.OOBTree import OOBTree
+
+# ZEO is only needed to share the database among several processes through a
+# storage server.
+try:
+	import ZEO
+	from ZEO.ClientStorage import ClientStorage
+except ImportError:
+	ZEO = None
+	ClientStorage = None
 
 #To exit the menu
 import sys
 
+# Used to group several changes in one transaction
+from contextlib import contextmanager
+
+# Used by the concurrent writers support: a connection per thread and the
+# retries after a conflict.
+import threading
+import time
+import random
+from functools import wraps
+from collections import OrderedDict
+import heapq
+import Queue
+import multiprocessing
+
+# Used to read the history of the database
+import datetime
+import calendar
+
+# Used by the local costing service
+import os
+import stat
+import errno
+import socket
+import SocketServer
+
+# Used to read the order and production log files
+import csv
+import itertools
+
+# Used to export and import the catalogues
+import json
+import gzip
 
-#Helper function to check the type before converting
+# numpy and scipy are only needed for the catalogue wide calculations
+# (requirements explosion), the menus work without them.
+try:
+	import numpy
+	from scipy import sparse
+except ImportError:
+	numpy = None
+	sparse = None
+
+
+# Currency of the costs when no other is given. The exchange rates are the
+# value in this currency of one unit of each currency.
+BASE_CURRENCY = "EUR"
+
+#Helper function to check the type before converting. None and other values
+#that are not numbers or strings are not numbers either.
 def is_number(s):
 	try:
 		float(s)
 		return True
-	except ValueError:
+	except (TypeError, ValueError):
 		return False
 
+#Helper function to open plain or gzip compressed files. By default the
+#compression is chosen by the file extension.
+def open_file(path, mode = "r", compress = None):
+	if compress is None:
+		compress = path.endswith(".gz")
+	if compress:
+		return gzip.open(path, mode + "b")
+	return open(path, mode + "b")
+
+#Helper function to convert a point in time to a transaction id. It accepts a
+#transaction id (8 bytes string, returned as it is), a datetime in UTC or the
+#seconds since the epoch.
+def as_tid(point):
+	if isinstance(point, str) and len(point) == 8:
+		return point
+	if isinstance(point, datetime.datetime):
+		point = calendar.timegm(point.utctimetuple()) + point.microsecond / 1e6
+	moment = time.gmtime(point)
+	return TimeStamp(*(moment[:5] + (moment[5] + point % 1,))).raw()
+
+#Decorator for the add methods of the catalogues. If the commit fails because
+#another process or thread changed the same objects, the transaction is aborted
+#and the method is run again after a random wait that doubles on each attempt.
+#The conflicts inside a batch, or with autocommit off, are raised when the
+#transaction commits, as the whole block would need to be repeated.
+def retry_on_conflict(method):
+	@wraps(method)
+	def retry(self, *args, **kwargs):
+		attempt = 0
+		while True:
+			try:
+				return method(self, *args, **kwargs)
+			except ConflictError:
+				Trax.conflicts += 1
+				if not self._autocommits():
+					raise
+				# the failed transaction is discarded even when giving up, so the
+				# thread can go on using the database
+				conflict = sys.exc_info()
+				self.abort()
+				if attempt >= self.retry_attempts:
+					raise conflict[0], conflict[1], conflict[2]
+				time.sleep(random.uniform(0, min(self.retry_backoff * 2 ** attempt,
+												 self.retry_max_backoff)))
+				attempt += 1
+				Trax.retries += 1
+	return retry
+
 class Product(Persistent):
 	"""Models a product composition by listing the materials and activities
 	needed to produce it.
@@ -34,7 +144,13 @@ class Product(Persistent):
 	Name: Name of the product.
 	Materials: List of materials, and amounts needed to make the product.
 	Activities: List of activities and its consumption needed to make the product. 
+	Kernel: The bills of materials and activities compiled to calculate the cost
+		quickly, see compileKernel.
 	"""
+	
+	# Products saved before the kernels were introduced don't have one, their
+	# kernel is built each time the cost is calculated.
+	kernel = None
 
 	def __init__(self, code, name, description, base_unit):
 		"""Creates a new product"""
@@ -43,6 +159,69 @@ class Product(Persistent):
 		self.description = description
 		self.bill_of_materials = PersistentDict()
 		self.bill_of_activities = PersistentDict()
+		self.compileKernel()
+		
+	def buildKernel(self):
+		"""Returns the bills of materials and activities reduced to the codes of the
+		components and the amount of each one needed per unit of F.P., already
+		including the production ratio and the waste. It is a tuple of tuples:
+			material codes, material coefficients,
+			activity codes, activity coefficients,
+			setup activity codes, setup coefficients (amount per lot).
+		Raises ZeroDivisionError if a production ratio is 0."""
+		
+		material_codes = []
+		material_coefficients = []
+		for material_code, material in self.bill_of_materials.items():
+			material_codes.append(material_code)
+			material_coefficients.append( material["consumption"] / 
+										  material["production_ratio"] *
+										  (1 + material["waste"]/100) )
+		
+		activity_codes = []
+		activity_coefficients = []
+		setup_codes = []
+		setup_coefficients = []
+		for activity_code, activity in self.bill_of_activities.items():
+			coefficient = activity["consumption"] / activity["production_ratio"]
+			if activity.get("setup"):
+				setup_codes.append(activity_code)
+				setup_coefficients.append(coefficient)
+			else:
+				activity_codes.append(activity_code)
+				activity_coefficients.append(coefficient)
+				
+		return (tuple(material_codes), tuple(material_coefficients),
+				tuple(activity_codes), tuple(activity_coefficients),
+				tuple(setup_codes), tuple(setup_coefficients))
+		
+	def compileKernel(self):
+		"""Saves the kernel of the product. It must be called each time the bills of
+		materials or activities change, addMaterial and addActivity already do it.
+		If a production ratio is 0 no kernel is saved and the cost is calculated
+		from the bills (raising the error)."""
+		
+		try:
+			self.kernel = self.buildKernel()
+		except ZeroDivisionError:
+			self.kernel = None
+			
+	def _catalogues(self):
+		"""Returns the materials and activities catalogues of the connection the
+		product was loaded from. A catalogue not created yet is empty."""
+		
+		if self._p_jar is not None:
+			root = self._p_jar.root()
+			return root.get('materials', {}), root.get('activities', {})
+		return MaterialTrax().materials, ActivityTrax().activities
+		
+	def _rates(self):
+		"""Returns the exchange rates table of the connection the product was loaded
+		from, None if there is not any."""
+		
+		if self._p_jar is not None:
+			return self._p_jar.root().get('fx_rates')
+		return Trax().root.get('fx_rates')
 		
 	def addMaterial(self, material_code, consumption, consumption_unit, 
 						  production_ratio, production_unit,  waste, cost_per_unit= 0 ):
@@ -108,7 +287,7 @@ class Product(Persistent):
 								'production_ratio': production_ratio * 1.0,
 								'waste' : waste * 1.0 ,
 								'cost_per_unit': cost_per_unit * 1.0}
-			self._p_changed = True
+			self.compileKernel()
 			return True, errors
 		else:		
 			return False, errors
@@ -116,7 +295,7 @@ class Product(Persistent):
 
 		
 	def addActivity(self, activity_code, consumption, activity_unit, 
-						  production_ratio, production_unit, cost_per_unit = 0):
+						  production_ratio, production_unit, cost_per_unit = 0, setup = False):
 		"""Adds a new activity in the product list needed to make the product and
 		the information related with the consumption for each unit on F.P. 
 		Parameters:
@@ -124,6 +303,9 @@ class Product(Persistent):
 		activiy_unit: Unit in which the consumption amount is expressed.
 		production_ratio: Units of F.P. to which the consumption is referred.
 		production_unit : Unit of production to which the production ratio is related.
+		setup: True if the activity is done once per lot (die changes, machine
+			preparation...). In that case production_ratio is the number of lots to
+			which the consumption is referred and its cost is shared by the units of the lot.
 		"""
 		
 				# First of all the the information validity is checked
@@ -164,59 +346,69 @@ class Product(Persistent):
 												'activity_unit': activity_unit,
 												'production_ratio': production_ratio * 1.0 ,
 												'production_unit': production_unit,
-												'cost_per_unit' : cost_per_unit * 1.0	}
-			self._p_changed = True
+												'cost_per_unit' : cost_per_unit * 1.0,
+												'setup': bool(setup)	}
+			self.compileKernel()
 			return True, errors
 			
 		return False, errors
 		
 		
-	def CalculateCost(self):
+	def CalculateCost(self, lot_size = 1, currency = None, rate_date = None, factors = None):
 		"""Calculates the direct product cost based on materials and activities consumption.
 		This function doesn't check yet:
 		A. Consumption units and price units for the activities are homogeneous.
 		B. production ratios per unit of output are homogeneous among the activities.
 		Parameters:
-		Product code
+		lot_size: Units of F.P. made in each lot. The setup activities cost is divided
+			among them.
+		currency: Currency of the result, BASE_CURRENCY by default.
+		rate_date: Date of the exchange rates used, the latest ones by default.
+		factors: {currency: factor} to convert the prices to the result currency, as
+			returned by FxTrax.factors. When costing many products it is better to get
+			them once and pass them here, then currency and rate_date are ignored.
+			A KeyError is raised if the currency of a component has no rate.
 		Returns two values:
 			1. Total material cost.
 			2. Total activity cost.
 		"""
 	
-		 # Recovers the information about activities and materials needed to calculate the cost
-		 # Maybe it would be better to filter the activities and materials in the bill of materials
-		 # and bill of activities. I will implement this later if too many materials or activities
-		 # are loaded in memory. One alternative is to save a reference to the material object as
-		 # ZODB database works exactly as if were python objects.
+		# The cost is the dot product of the kernel coefficients and the current
+		# cost per unit of each material and activity.
+		kernel = self.kernel
+		if kernel is None:
+			kernel = self.buildKernel()
+		(material_codes, material_coefficients, activity_codes, activity_coefficients,
+		 setup_codes, setup_coefficients) = kernel
 		 
-		activitytrax = ActivityTrax().activities
-		materialtrax = MaterialTrax().materials
+		materialtrax, activitytrax = self._catalogues()
+		
+		if factors is None:
+			factors = FxTrax.conversion_factors(self._rates(), currency or BASE_CURRENCY, 
+												rate_date)
 		
-		# initialize the accum for the cost of materials and activities
 		material_cost = 0
+		for code, coefficient in zip(material_codes, material_coefficients):
+			material = materialtrax[code]
+			material_cost += material.cost_per_unit * factors[material.currency] * coefficient
+			
 		activity_cost = 0
-		
-		# calculates the cost of each material and adds it to the material accum.
-		# takes into account the production ratio and material waste
-		for material_code, material in self.bill_of_materials.items():
-			material_cost += ( 	materialtrax[material_code].cost_per_unit * 
-								material["consumption"] / 
-								material["production_ratio"] *
-								(1 + material["waste"]/100) 
-							)
-		# Idem as above for activities but no waste is introduced
-		for activity_code, activity in self.bill_of_activities.items():
-			activity_cost += ( 	activitytrax[activity_code].cost_per_unit * 
-								activity["consumption"] /
-								activity["production_ratio"] 
-							)
-		
+		for code, coefficient in zip(activity_codes, activity_coefficients):
+			activity = activitytrax[code]
+			activity_cost += activity.cost_per_unit * factors[activity.currency] * coefficient
+			
+		# setup activities are consumed once per lot
+		setup_cost = 0
+		for code, coefficient in zip(setup_codes, setup_coefficients):
+			activity = activitytrax[code]
+			setup_cost += activity.cost_per_unit * factors[activity.currency] * coefficient
+		activity_cost += setup_cost / lot_size
 	
 		return    material_cost , activity_cost 
 		
 	def PrintCost(self):
 	
-		material_cost, activity_cost = self.CalculateCost()
+		material_cost, activity_cost = cost_cache.get(self)
 		
 		total_cost = material_cost + activity_cost
 		
@@ -268,7 +460,7 @@ class Product(Persistent):
 				str(activity["consumption"]) + " " * (13 - len(str(activity["consumption"]))) +
 				activity["activity_unit"] + " " * (13 - len(activity["activity_unit"])) +
 				str(activity["production_ratio"]) + " " +
-				activity["production_unit"] + "\n"
+				activity["production_unit"] + (" (setup per lot)" if activity.get("setup") else "") + "\n"
 				)
 		
 		activity_string += "*" * 80 + "\n"
@@ -286,21 +478,28 @@ class Activity(Persistent):
 	Code: Material code. It's an integer.
 	Name: Material name. The name should be descriptive enough to differentiate from any other material.
 	Description: Additional information that will help to describe the material.
-	Cost per unit: Cost in Euros of the material according to the base unit.
-	Base unit: Unit in which the material is used."""
+	Cost per unit: Cost of the material according to the base unit, in its currency.
+	Base unit: Unit in which the material is used.
+	Currency: Currency of the cost per unit (BASE_CURRENCY by default)."""
+	
+	# activities saved before the currencies were introduced are in euros
+	currency = BASE_CURRENCY
 
-	def __init__(self, code, name, description, cost_per_unit, activity_unit):
+	def __init__(self, code, name, description, cost_per_unit, activity_unit,
+				 currency = BASE_CURRENCY):
 
 		self.code = code
 		self.name = name
 		self.description = description
 		self.cost_per_unit = cost_per_unit
 		self.activity_unit = activity_unit
+		self.currency = currency
 		
 	def __str__(self):
 
-		return ("Activity Code: %s, Name: %s,\n Description: %s,\n Cost per unit: %s\n Base unit: %s"
-				% (self.code, self.name, self.description, self.cost_per_unit, self.activity_unit))
+		return ("Activity Code: %s, Name: %s,\n Description: %s,\n Cost per unit: %s %s\n Base unit: %s"
+				% (self.code, self.name, self.description, self.cost_per_unit, self.currency,
+				   self.activity_unit))
 		
 		
 class Material(Persistent):
@@ -310,33 +509,647 @@ class Material(Persistent):
 	Code: Material code. It's an integer.
 	Name: Material name. The name should be descriptive enough to differentiate from any other material.
 	Description: Additional information that will help to describe the material.
-	Cost per unit: Cost in Euros of the material according to the base unit.
-	Base unit: Unit in which the material is used."""
+	Cost per unit: Cost of the material according to the base unit, in its currency.
+	Base unit: Unit in which the material is used.
+	Currency: Currency of the cost per unit (BASE_CURRENCY by default)."""
+	
+	# materials saved before the currencies were introduced are in euros
+	currency = BASE_CURRENCY
 	
-	def __init__(self, code, name, description, cost_per_unit, base_unit):
+	def __init__(self, code, name, description, cost_per_unit, base_unit,
+				 currency = BASE_CURRENCY):
 		self.code = code
 		self.name = name
 		self.description = description
 		self.cost_per_unit = cost_per_unit
 		self.base_unit = base_unit
+		self.currency = currency
 	
 	def __str__(self):
 	
-		return ("Material Code: %s, Name: %s,\n Description: %s,\n Cost per unit: %s\n Base unit: %s"
-				% (self.code, self.name, self.description, self.cost_per_unit, self.base_unit))
-		
+		return ("Material Code: %s, Name: %s,\n Description: %s,\n Cost per unit: %s %s\n Base unit: %s"
+				% (self.code, self.name, self.description, self.cost_per_unit, self.currency,
+				   self.base_unit))
+		
+class CostCache(object):
+	"""Bounded LRU cache of the (material cost, activity cost) of the products,
+	by product code, lot size and currency conversion factors. Each entry keeps the serials (_p_serial, the
+	transaction that saved each object) of the product and of the materials and
+	activities it uses, and it is only used while they are the same: any change
+	committed to any of those objects, from this or any other process,
+	invalidates it. Products or components with changes not yet committed are
+	never cached.
+	
+	Parameters:
+	size: Maximum number of entries. The least recently used is evicted first.
+	enabled: If False the costs are always calculated.
+	"""
+	
+	def __init__(self, size = 1000, enabled = True):
+		self.size = size
+		self.enabled = enabled
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+		self.clear()
+		
+	def clear(self):
+		"""Empties the cache and resets the statistics."""
+		
+		with self._lock:
+			self._entries.clear()
+			self.hits = 0
+			self.misses = 0
+			self.evictions = 0
+			self.invalidations = 0
+	
+	def _serials(self, product):
+		"""Returns the serials of the product and of its materials and activities,
+		or None if any of them has uncommitted changes or was never committed."""
+		
+		objects = [product]
+		kernel = product.kernel
+		if kernel is None:
+			# the cost depends on the bills
+			objects.extend((product.bill_of_materials, product.bill_of_activities))
+			kernel = product.buildKernel()
+			
+		materials, activities = product._catalogues()
+		objects.extend(materials[code] for code in kernel[0])
+		objects.extend(activities[code] for code in kernel[2] + kernel[4])
+		
+		serials = []
+		for item in objects:
+			# new objects have no serial yet, and are not marked as changed
+			if item._p_oid is None or item._p_jar is None:
+				return None
+			item._p_activate()
+			if item._p_changed:
+				return None
+			serials.append(item._p_serial)
+		return tuple(serials)
+		
+	def get(self, product, lot_size = 1, factors = None):
+		"""Returns the material and activity cost of a product, as Product.CalculateCost.
+		Without factors the costs are in BASE_CURRENCY at the latest exchange rates."""
+		
+		if factors is None:
+			factors = FxTrax.conversion_factors(product._rates())
+			
+		if not self.enabled:
+			return product.CalculateCost(lot_size, factors = factors)
+			
+		# changing an exchange rate changes the factors and so the key
+		key = (product.code, lot_size, tuple(sorted(factors.items())))
+		serials = self._serials(product)
+		
+		with self._lock:
+			entry = self._entries.pop(key, None)
+			if entry is not None:
+				if serials is not None and entry[0] == serials:
+					# most recently used entries are at the end
+					self._entries[key] = entry
+					self.hits += 1
+					return entry[1]
+				self.invalidations += 1
+			self.misses += 1
+		
+		cost = product.CalculateCost(lot_size, factors = factors)
+		
+		if serials is not None:
+			with self._lock:
+				self._entries[key] = (serials, cost)
+				while len(self._entries) > self.size:
+					self._entries.popitem(last = False)
+					self.evictions += 1
+		
+		return cost
+		
+	def stats(self):
+		"""Returns a dictionary with the size, number of entries, hits, misses,
+		evictions and invalidations of the cache."""
+		
+		with self._lock:
+			return {'size': self.size,
+					'entries': len(self._entries),
+					'enabled': self.enabled,
+					'hits': self.hits,
+					'misses': self.misses,
+					'evictions': self.evictions,
+					'invalidations': self.invalidations}
+
+# Cost cache used by Product.PrintCost, the costing service and
+# ProductTrax.calculate_costs when numpy is not available.
+cost_cache = CostCache()
+			
 class Trax(object):
-	"""Superclass that allows to manage the company's product cost information."""
+	"""Superclass that allows to manage the company's product cost information.
+	
+	All the catalogues share the same database connection. It is opened the first
+	time a Trax object is created, or explicitly through Trax.open to choose the
+	database file and the cache settings.
+	
+	Several processes can use the same database through a ZEO storage server:
+	the server is started with Trax.start_server (or the runzeo script) and each
+	process calls Trax.open(zeo_address = address). The ZEO client keeps its own
+	cache of the objects loaded from the server, client_cache_size bytes, which is
+	kept on disk between runs when a client name is given.
+	
+	Memory budget mode: when scan_batch_size is set, the catalogue wide passes
+	(see scan) ghost the objects already visited every scan_batch_size objects,
+	so the memory used does not grow with the size of the catalogue.
+	
+	By default every add method commits its changes. With autocommit False the
+	changes are kept in the current transaction until commit is called; the batch
+	context manager does the same for a block of code:
+	
+		with products.batch():
+			products.addMaterial(...)
+			materials.addMaterial(...)
+	
+	The transaction and the batch in progress belong to the thread, not to the
+	Trax object: inside a batch no catalogue commits its changes, and they are
+	all committed or discarded together when the batch ends. In the same way,
+	while a catalogue with autocommit False has changes pending in the thread
+	transaction, the other catalogues leave theirs pending too, until commit or
+	abort is called.
+	
+	Concurrent writers: every thread gets its own connection and transaction, so
+	several threads (each one with its own Trax objects) can write at the same
+	time. The add methods retry the transactions that fail because of a write
+	conflict up to retry_attempts times, see retry_on_conflict."""
 
-	storage = FileStorage("products.fs")
-	db = DB(storage)
-	connection = db.open()
-	root = connection.root()
+	storage = None
+	db = None
+	# connection of each thread
+	_local = threading.local()
+	
+	# Maximum number of objects and bytes (0 means no limit) kept in the
+	# connection cache between transactions.
+	cache_size = 400
+	cache_size_bytes = 0
+	
+	# ZEO client cache size in bytes and directory where the persistent client
+	# cache files are saved (the current directory by default).
+	client_cache_size = 20 * 1024 * 1024
+	client_cache_dir = None
+	
+	# Number of objects visited by scan before emptying the cache. None means the
+	# cache is only limited by cache_size and cache_size_bytes.
+	scan_batch_size = None
+	
+	# Objects found in memory (hits) or loaded from the storage (misses) by scan.
+	scan_hits = 0
+	scan_misses = 0
+	
+	# Retry policy after a write conflict: attempts and the maximum random wait
+	# in seconds before the first retry, doubled on each attempt up to
+	# retry_max_backoff.
+	retry_attempts = 10
+	retry_backoff = 0.01
+	retry_max_backoff = 1.0
+	
+	# Conflicts found and transactions retried by all the catalogues.
+	conflicts = 0
+	retries = 0
 
 	def __init__(self, intro = "Product trax product tracking helper",
-			 db_path="products.fs"):
+			 db_path="products.fs", autocommit = True):
 				 
 		self.intro = intro
+		self.autocommit = autocommit
+		
+		if Trax.db is None:
+			Trax.open(db_path)
+			
+	@property
+	def connection(self):
+		"""Connection of the current thread, opened the first time it is needed."""
+		
+		local = Trax._local
+		if getattr(local, 'db', None) is not Trax.db:
+			local.db = Trax.db
+			local.connection = Trax.db.open()
+		return local.connection
+		
+	@property
+	def root(self):
+		"""Root object of the current thread connection."""
+		
+		return self.connection.root()
+		
+	@staticmethod
+	def release():
+		"""Closes the connection of the current thread so it can be reused by other
+		threads. Threads that finish using the database should call it."""
+		
+		local = Trax._local
+		if getattr(local, 'db', None) is Trax.db and Trax.db is not None:
+			transaction.abort()
+			local.connection.close()
+		local.db = local.connection = None
+			
+	@staticmethod
+	def open(db_path = "products.fs", cache_size = None, cache_size_bytes = None,
+			 scan_batch_size = None, zeo_address = None, client_name = None,
+			 client_cache_size = None, client_cache_dir = None):
+		"""Opens the database shared by all the catalogues. If it was already open
+		it is closed first. The cache parameters not given keep their current value.
+		Parameters:
+		db_path: FileStorage file, not used when a zeo_address is given.
+		zeo_address: (host, port) or Unix socket path of a ZEO storage server.
+		client_name: name of the persistent ZEO client cache. Without it the client
+			cache is lost when the database is closed.
+		client_cache_size, client_cache_dir: ZEO client cache size and directory.
+		"""
+		
+		if client_cache_size is not None:
+			Trax.client_cache_size = client_cache_size
+		if client_cache_dir is not None:
+			Trax.client_cache_dir = client_cache_dir
+		if cache_size is not None:
+			Trax.cache_size = cache_size
+		if cache_size_bytes is not None:
+			Trax.cache_size_bytes = cache_size_bytes
+		if scan_batch_size is not None:
+			Trax.scan_batch_size = scan_batch_size
+			
+		Trax.close()
+		
+		if zeo_address is None:
+			Trax.storage = FileStorage(db_path)
+		elif ClientStorage is None:
+			raise ImportError("ZEO is needed to connect to a storage server")
+		else:
+			Trax.storage = ClientStorage(zeo_address, cache_size = Trax.client_cache_size,
+										 client = client_name, var = Trax.client_cache_dir)
+			
+		Trax.db = DB(Trax.storage, cache_size = Trax.cache_size,
+					 cache_size_bytes = Trax.cache_size_bytes)
+		
+	@staticmethod
+	def start_server(db_path = "products.fs", port = 0):
+		"""Starts a ZEO storage server for db_path in a separate process, mainly for
+		tests and local deployments. Returns the server address, to be passed to
+		Trax.open, and a function that stops the server."""
+		
+		if ZEO is None:
+			raise ImportError("ZEO is needed to start a storage server")
+			
+		return ZEO.server(path = db_path, port = port, threaded = False)
+		
+	@staticmethod
+	def close():
+		"""Closes the database if it is open. Uncommitted changes are lost."""
+		
+		if Trax.db is None:
+			return
+			
+		transaction.abort()
+		if getattr(Trax._local, 'db', None) is Trax.db:
+			Trax._local.connection.close()
+		Trax._local.db = Trax._local.connection = None
+		Trax.db.close()
+		Trax.storage = Trax.db = None
+		
+	def _snapshot(self):
+		"""Returns an id of the database state seen by the current thread connection:
+		it changes when the connection sees a transaction committed by this or any
+		other process. Returns None if the connection has changes not committed yet,
+		as then the state is not the one of any transaction."""
+		
+		connection = self.connection
+		if connection._registered_objects or connection._savepoint_storage is not None:
+			return None
+		# the MVCC adapter reads the objects as of this transaction
+		return getattr(connection._storage, '_start', None)
+		
+	def _catalogue(self, name):
+		"""Returns the catalogue saved in the database root with the given name,
+		creating it if it doesn't exist yet."""
+		
+		if name not in self.root:
+			self.root[name] = OOBTree()
+		return self.root[name]
+		
+	def migrate_catalogues(self):
+		"""Converts the catalogues created as PersistentDict by older versions to
+		OOBTrees, which can be written by several processes at the same time.
+		The Trax objects created before must be created again.
+		Returns the names of the catalogues converted."""
+		
+		migrated = []
+		for name in ('products', 'materials', 'activities'):
+			if isinstance(self.root.get(name), PersistentDict):
+				self.root[name] = OOBTree(self.root[name])
+				migrated.append(name)
+				
+		if migrated:
+			self.commit()
+		return migrated
+		
+	def commit(self):
+		"""Commits the changes pending in the current transaction."""
+		
+		transaction.commit()
+		
+	def abort(self):
+		"""Discards the changes pending in the current transaction."""
+		
+		transaction.abort()
+		self._discarded()
+		
+	def _discarded(self):
+		"""Called when uncommitted changes are discarded. Subclasses drop here any
+		information built from them."""
+		pass
+		
+	def _autocommits(self):
+		"""Returns True if the add methods commit each change: autocommit is on,
+		the current thread is not inside a batch and its transaction has no
+		changes left pending by other catalogues."""
+		
+		local = Trax._local
+		return (self.autocommit and not getattr(local, 'batches', 0) and 
+				not self._pending_changes())
+		
+	def _pending_changes(self):
+		"""Returns the number of changes left pending by the add methods in the
+		current transaction of the thread."""
+		
+		local = Trax._local
+		if getattr(local, 'transaction', None) is not transaction.get():
+			return 0
+		return local.pending
+		
+	def _commit(self):
+		"""Commits the change just made by an add method if _autocommits.
+		Otherwise it is left pending, taking a savepoint every savepoint_every 
+		changes of the current transaction (see batch) so they don't need to be
+		kept in memory."""
+		
+		if self._autocommits():
+			self.commit()
+			return
+			
+		# the changes are counted per transaction of the thread
+		local = Trax._local
+		local.pending = self._pending_changes() + 1
+		local.transaction = transaction.get()
+		
+		savepoint_every = getattr(local, 'savepoint_every', None)
+		if savepoint_every and local.pending % savepoint_every == 0:
+			transaction.savepoint(True)
+			
+	@contextmanager
+	def batch(self, savepoint_every = None):
+		"""Context manager that commits all the changes made inside the block at
+		once when it exits, through this or any other catalogue of the thread, as
+		well as the changes already pending in its transaction. If an exception is
+		raised the transaction is aborted and the exception is raised again.
+		Parameters:
+		savepoint_every: take a savepoint every savepoint_every changes.
+		Batches can be nested: only the outermost one commits, an inner one that
+		fails rolls back its own changes only."""
+		
+		local = Trax._local
+		depth = getattr(local, 'batches', 0)
+		previous = getattr(local, 'savepoint_every', None)
+		
+		if savepoint_every is not None:
+			local.savepoint_every = savepoint_every
+		start = transaction.savepoint(True) if depth else None
+		local.batches = depth + 1
+		
+		try:
+			yield self
+		except:
+			if depth:
+				start.rollback()
+				self._discarded()
+			else:
+				self.abort()
+			raise
+		else:
+			if not depth:
+				self.commit()
+		finally:
+			local.batches = depth
+			local.savepoint_every = previous
+		
+	def scan(self, catalogue, batch_size = None):
+		"""Iterates over the (code, object) pairs of a catalogue (products, materials
+		or activities). In memory budget mode the objects are turned into ghosts every
+		batch_size objects (scan_batch_size by default) so a full catalogue pass does
+		not keep every object in memory. Objects changed and not committed are never
+		ghosted."""
+		
+		if batch_size is None:
+			batch_size = Trax.scan_batch_size
+			
+		count = 0
+		for code, item in catalogue.items():
+			if getattr(item, '_p_status', None) == 'ghost':
+				Trax.scan_misses += 1
+			else:
+				Trax.scan_hits += 1
+				
+			yield code, item
+			
+			count += 1
+			if batch_size and count % batch_size == 0:
+				self.connection.cacheMinimize()
+				
+	def cache_report(self):
+		"""Returns a dictionary with the cache settings and statistics:
+			cache_size, cache_size_bytes: current limits.
+			resident_objects: objects with their state loaded in memory.
+			cached_objects: objects in the cache, including ghosts.
+			estimated_bytes: estimated memory used by the resident objects.
+			loads, stores: objects read from and written to the storage.
+			scan_hits, scan_misses: objects found in memory or loaded by scan.
+		When connected to a ZEO server it also includes:
+			client_cache_hits: loads served by the ZEO client cache.
+			client_cache_adds, client_cache_evicts: objects stored in and removed 
+				from the client cache.
+			client_cache_size: client cache size in bytes.
+		"""
+		
+		cache = self.connection._cache
+		loads, stores = self.connection.getTransferCounts()
+		
+		report = {'cache_size': Trax.db.getCacheSize(),
+				'cache_size_bytes': Trax.db.getCacheSizeBytes(),
+				'resident_objects': cache.cache_non_ghost_count,
+				'cached_objects': len(cache),
+				'estimated_bytes': cache.total_estimated_size,
+				'loads': loads,
+				'stores': stores,
+				'scan_hits': Trax.scan_hits,
+				'scan_misses': Trax.scan_misses}
+				
+		if ClientStorage is not None and isinstance(Trax.storage, ClientStorage):
+			client_cache = Trax.storage._cache
+			adds, added_bytes, evicts, evicted_bytes, hits = client_cache.getStats()
+			report.update({'client_cache_hits': hits,
+						   'client_cache_adds': adds,
+						   'client_cache_evicts': evicts,
+						   'client_cache_size': client_cache.maxsize})
+		
+		return report
+				
+	def export_catalogue(self, path, compress = None):
+		"""Writes the materials, activities and products catalogues, including the
+		bills of materials and activities, to a JSON Lines file (gzip compressed if
+		compress is True or the path ends with .gz). Each line is an object whose
+		"type" is material, activity, product, bom_material, bom_activity or fx_rate. The
+		catalogues are read through scan so the memory used does not depend on their
+		size. Returns a dictionary with the number of lines written of each type."""
+		
+		counts = {'material': 0, 'activity': 0, 'product': 0,
+				  'bom_material': 0, 'bom_activity': 0, 'fx_rate': 0}
+		
+		def write(output, record_type, record):
+			record['type'] = record_type
+			output.write(json.dumps(record) + "\n")
+			counts[record_type] += 1
+			
+		with open_file(path, "w", compress) as output:
+			for currency, history in self.root.get('fx_rates', {}).items():
+				for rate_date, rate in history.items():
+					write(output, 'fx_rate', {'currency': currency, 'date': rate_date,
+											  'rate': rate})
+											  
+			for code, material in self.scan(self.root.get('materials', {})):
+				write(output, 'material', {'code': code,
+							'name': material.name,
+							'description': material.description,
+							'cost_per_unit': material.cost_per_unit,
+							'currency': material.currency,
+							'base_unit': material.base_unit})
+				
+			for code, activity in self.scan(self.root.get('activities', {})):
+				write(output, 'activity', {'code': code,
+							'name': activity.name,
+							'description': activity.description,
+							'cost_per_unit': activity.cost_per_unit,
+							'currency': activity.currency,
+							'activity_unit': activity.activity_unit})
+			
+			# the bill lines follow its product so they can be imported in one pass
+			for code, product in self.scan(self.root.get('products', {})):
+				write(output, 'product', {'code': code,
+							'name': product.name,
+							'description': product.description,
+							'base_unit': getattr(product, 'base_unit', None)})
+							
+				for line in product.bill_of_materials.values():
+					record = dict(line)
+					record['product_code'] = code
+					write(output, 'bom_material', record)
+					
+				for line in product.bill_of_activities.values():
+					record = dict(line)
+					record['product_code'] = code
+					write(output, 'bom_activity', record)
+					
+		return counts
+		
+	def import_catalogue(self, path, batch_size = 1000, compress = None):
+		"""Loads a file written by export_catalogue into empty catalogues, normally
+		in a fresh database opened with Trax.open. The records are not validated
+		again, they are stored as they were exported and committed every batch_size
+		records, emptying the cache after each commit. Only the bill lines are
+		checked to have the numbers needed to compile the product kernels. The text
+		is stored as UTF-8 strings, as entered through the menus.
+		Returns True and an error dictionary with the lines that could not be loaded
+		(line number: error), or False and the error if the catalogues are not empty."""
+		
+		catalogues = {}
+		for name in ('materials', 'activities', 'products', 'fx_rates'):
+			catalogues[name] = self._catalogue(name)
+			if len(catalogues[name]):
+				return False, {'catalogue_not_empty': "The %s catalogue is not empty." % name}
+		
+		materials = catalogues['materials']
+		activities = catalogues['activities']
+		products = catalogues['products']
+		rates = catalogues['fx_rates']
+		
+		errors = {}
+		pending = 0
+		# product whose bill lines are being read, its kernel is compiled when the
+		# next product starts
+		product = None
+		
+		def text(value):
+			# json returns unicode strings
+			if isinstance(value, unicode):
+				return value.encode("utf-8")
+			return value
+			
+		# numbers needed by Product.buildKernel
+		numbers = {'bom_material': ('consumption', 'production_ratio', 'waste'),
+				   'bom_activity': ('consumption', 'production_ratio')}
+		
+		with open_file(path, "r", compress) as source:
+			for number, line in enumerate(source, 1):
+				if not line.strip():
+					continue
+				try:
+					record = json.loads(line)
+					if not isinstance(record, dict):
+						raise ValueError("record is not a JSON object")
+					record = dict((text(key), text(value)) for key, value in record.items())
+					record_type = record.pop('type')
+					for key in numbers.get(record_type, ()):
+						if not is_number(record.get(key)):
+							raise ValueError("%s must be a number" % key)
+					
+					if record_type == 'material':
+						materials[record['code']] = Material(record['code'], record['name'], 
+							record['description'], record['cost_per_unit'], record['base_unit'],
+							str(record.get('currency', BASE_CURRENCY)))
+					elif record_type == 'activity':
+						activities[record['code']] = Activity(record['code'], record['name'], 
+							record['description'], record['cost_per_unit'], record['activity_unit'],
+							str(record.get('currency', BASE_CURRENCY)))
+					elif record_type == 'fx_rate':
+						currency = str(record['currency'])
+						if currency not in rates:
+							rates[currency] = OOBTree()
+						rates[currency][FxTrax.date_key(record['date'])] = record['rate']
+					elif record_type == 'product':
+						if product is not None:
+							product.compileKernel()
+						product = products[record['code']] = Product(record['code'], 
+							record['name'], record['description'], record['base_unit'])
+					elif record_type in ('bom_material', 'bom_activity'):
+						bill_product = products[record.pop('product_code')]
+						if bill_product is not product:
+							if product is not None:
+								product.compileKernel()
+							product = bill_product
+						if record_type == 'bom_material':
+							product.bill_of_materials[record['material_code']] = record
+						else:
+							product.bill_of_activities[record['activity_code']] = record
+					else:
+						errors[number] = "Unknown record type: %s" % record_type
+						continue
+				except (ValueError, KeyError) as error:
+					errors[number] = "Wrong record: %s" % error
+					continue
+					
+				pending += 1
+				if pending >= batch_size:
+					transaction.commit()
+					self.connection.cacheMinimize()
+					pending = 0
+		
+		if product is not None:
+			product.compileKernel()
+		transaction.commit()
+		return True, errors
 
 		
 class ProductTrax(Trax):
@@ -345,16 +1158,24 @@ class ProductTrax(Trax):
 	loads the data from the database."""
 
 	def __init__(self, intro = "Product trax  tracking helper",
-			 db_path="products.fs"):
+			 db_path="products.fs", autocommit = True):
 
-		Trax.__init__(self)
+		Trax.__init__(self, intro, db_path, autocommit)
 		
-		if 'products' in self.root:
-			self.products = self.root['products']
-		else:
-			self.products = self.root['products'] = PersistentDict()
+		self.products = self._catalogue('products')
+			
+		# coefficient matrix used by explode, built the first time it is needed,
+		# and the database state it was built from
+		self._requirements = None
+		self._requirements_snapshot = None
+		
+	def _discarded(self):
+		"""The requirements matrix may include the discarded changes."""
+		
+		self._requirements = None
 
 
+	@retry_on_conflict
 	def addProduct(self, code, name, description, base_unit):
 		"""Adds a new product to the Company's catalogue. If the code is 
 		already in use or is not valid returns False. If is valid returns
@@ -365,11 +1186,13 @@ class ProductTrax(Trax):
 		
 		product = Product( code, name, description, base_unit)
 		self.products[code] = product
-		transaction.commit()
+		self._commit()
+		self._requirements = None
 		return True
 		
+	@retry_on_conflict
 	def addActivity(self, product_code, activity_code, consumption, activity_unit, 
-						  production_ratio, production_unit, cost_per_unit = 0):
+						  production_ratio, production_unit, cost_per_unit = 0, setup = False):
 		"""Adds a new activity to the bill of activities of an existent product. The parameters
 		are the same of the Product class plus the product's code to which we add the activity"""				  
 		
@@ -378,14 +1201,16 @@ class ProductTrax(Trax):
 		else:
 			product = self.products[product_code]
 			valid, errors = product.addActivity( activity_code, consumption, activity_unit, 
-							  production_ratio, production_unit, cost_per_unit = 0)
+							  production_ratio, production_unit, cost_per_unit = 0, setup = setup)
 							  
 			if valid: 				  
-				transaction.commit()
+				self._commit()
+				self._requirements = None
 				return True, errors
 			else:
 				return False, errors
 		
+	@retry_on_conflict
 	def addMaterial(self, product_code, material_code, consumption, consumption_unit, 
 						  production_ratio, production_unit,  waste, cost_per_unit= 0 ):
 		"""Adds a new material to the bill of materials of an existent product. The parameters
@@ -399,7 +1224,8 @@ class ProductTrax(Trax):
 			valid, errors = product.addMaterial( material_code, consumption, consumption_unit, 
 							  production_ratio, production_unit,  waste, cost_per_unit= 0 )
 			if valid:
-				transaction.commit()
+				self._commit()
+				self._requirements = None
 				return True, errors
 			else:
 				print errors
@@ -413,27 +1239,987 @@ class ProductTrax(Trax):
 	
 		return self.products[product_code]
 		
+	def where_used(self, material_code = None, activity_code = None):
+		"""Returns the codes of the products that use the material or the activity
+		given."""
+		
+		used = []
+		for code, product in self.scan(self.products):
+			kernel = product.kernel
+			if kernel is None:
+				# a bill that cannot be compiled still uses its components
+				kernel = (product.bill_of_materials.keys(), None, 
+						  product.bill_of_activities.keys(), None, (), None)
+			if material_code is not None and material_code in kernel[0]:
+				used.append(code)
+			elif activity_code is not None and (activity_code in kernel[2] or 
+												activity_code in kernel[4]):
+				used.append(code)
+		return used
+		
+	def cost_changes(self, start, end = None):
+		"""Compares the product costs at two points of the database history, given
+		as transaction ids, UTC datetimes or seconds since the epoch (see as_tid);
+		end is the last transaction by default and a start before the first one
+		means an empty database. Only the transaction records saved between both
+		points are read from the storage to find the materials, activities,
+		products and exchange rates changed. The catalogues at each point are read
+		through historical connections that load only the objects needed. When some
+		material or activity price, currency or exchange rate changed, the products
+		using them are found in the requirements matrix if end is the state seen by
+		this object; otherwise the product catalogue is visited (kernels only),
+		emptying the cache every scan_batch_size products (1000 by default).
+		Products whose cost cannot be calculated (see check_integrity) are left out.
+		Returns a list with a dictionary for each product whose cost changed:
+			product_code: code of the product.
+			old_cost, new_cost: (material cost, activity cost) at start and end; 
+				old_cost is None for products created in between.
+			delta: change of the total cost.
+			causes: list of the changes that explain it, dictionaries with a type:
+				material_price / activity_price: code, old and new cost per unit, and
+					old_currency and new_currency of the prices.
+				fx_rate: currency, old and new value in BASE_CURRENCY of one unit
+					of it, at the latest rates of each point.
+				bill_of_materials / bill_of_activities / setup_activities: code and
+					old and new amount per unit of F.P. (None if the line was added
+					or removed).
+				new_product.
+		"""
+		
+		# historical connections cannot be opened after the last transaction, nor
+		# before the root object was created
+		last = Trax.storage.lastTransaction()
+		start = min(as_tid(start), last)
+		end = last if end is None else min(as_tid(end), last)
+		
+		# objects changed after start up to end, by class name. The exchange rates
+		# are kept in BTrees, so they may have changed only if some BTree did.
+		changed = {'Material': set(), 'Activity': set(), 'Product': set()}
+		trees_changed = False
+		for record_transaction in Trax.storage.iterator(p64(u64(start) + 1), end):
+			for record in record_transaction:
+				if record.data is None:
+					continue
+				class_name = get_pickle_metadata(record.data)[1]
+				if class_name in changed:
+					changed[class_name].add(record.oid)
+				elif class_name in ('OOBTree', 'OOBucket'):
+					trees_changed = True
+					
+		# before the first transaction the catalogues were empty
+		if Trax.storage.loadBefore(z64, p64(u64(start) + 1)) is None:
+			old_connection = None
+		else:
+			old_connection = Trax.db.open(at = start)
+		new_connection = Trax.db.open(at = end)
+		
+		# historical connections do not empty their cache, it is done every
+		# batch_size objects visited so the memory used does not grow with the size
+		# of the catalogues
+		batch_size = Trax.scan_batch_size or 1000
+		
+		def visit(items):
+			for count, item in enumerate(items, 1):
+				yield item
+				if count % batch_size == 0:
+					new_connection.cacheMinimize()
+					if old_connection is not None:
+						old_connection.cacheMinimize()
+		
+		try:
+			old_root = old_connection.root() if old_connection is not None else {}
+			new_root = new_connection.root()
+			
+			def price_changes(class_name):
+				"""Returns {code: (old cost per unit, new cost per unit, old currency,
+				new currency)}."""
+				prices = {}
+				for oid in changed[class_name]:
+					new = new_connection.get(oid)
+					try:
+						if old_connection is None:
+							raise KeyError(oid)
+						old = old_connection.get(oid)
+						old_price = old.cost_per_unit, old.currency
+					except KeyError:
+						# created after start
+						old_price = None, None
+					if old_price != (new.cost_per_unit, new.currency):
+						prices[new.code] = (old_price[0], new.cost_per_unit, 
+											old_price[1], new.currency)
+				return prices
+				
+			material_prices = price_changes('Material')
+			activity_prices = price_changes('Activity')
+			
+			# {currency: (old factor, new factor)} to BASE_CURRENCY at the latest rates
+			rate_changes = {}
+			if trees_changed:
+				old_factors = FxTrax.conversion_factors(old_root.get('fx_rates'))
+				new_factors = FxTrax.conversion_factors(new_root.get('fx_rates'))
+				for currency, factor in new_factors.items():
+					if old_factors.get(currency) != factor:
+						rate_changes[currency] = (old_factors.get(currency), factor)
+			
+			# components priced in a currency whose rate changed
+			rate_materials = set()
+			rate_activities = set()
+			if rate_changes:
+				for code, material in visit(new_root.get('materials', {}).items()):
+					if material.currency in rate_changes:
+						rate_materials.add(code)
+				for code, activity in visit(new_root.get('activities', {}).items()):
+					if activity.currency in rate_changes:
+						rate_activities.add(code)
+			
+			products = set(new_connection.get(oid).code for oid in changed['Product'])
+			
+			material_codes = set(material_prices) | rate_materials
+			activity_codes = set(activity_prices) | rate_activities
+			if not material_codes and not activity_codes:
+				# only bills changed, the products are already known
+				pass
+			elif sparse is not None and self._snapshot() == p64(u64(end) + 1):
+				# this connection sees the database at end: the products using the
+				# components changed are found in the rows of the requirements matrix
+				requirements = self.requirements_matrix()
+				material_count = len(requirements['materials'])
+				activity_rows = [row for row, code in enumerate(requirements['activities'])
+								 if code in activity_codes]
+				rows = [row for row, code in enumerate(requirements['materials'])
+						if code in material_codes]
+				rows.extend(row + material_count for row in activity_rows)
+				columns = set(requirements['matrix'][rows].indices)
+				columns.update(requirements['setup'][activity_rows].indices)
+				products.update(requirements['products'][column] for column in columns)
+			else:
+				for code, product in visit(new_root.get('products', {}).items()):
+					kernel = product.kernel
+					if kernel is None:
+						try:
+							kernel = product.buildKernel()
+						except ZeroDivisionError:
+							continue
+					if (any(material in material_codes for material in kernel[0]) or
+						any(activity in activity_codes for activity in kernel[2] + kernel[4])):
+						products.add(code)
+			
+			old_products = old_root.get('products', {})
+			new_products = new_root['products'] if products else {}
+			
+			changes = []
+			for code in visit(products):
+				new = new_products[code]
+				old = old_products[code] if code in old_products else None
+				
+				try:
+					new_cost = new.CalculateCost()
+					old_cost = old.CalculateCost() if old is not None else None
+				except ZeroDivisionError:
+					# a production ratio of 0, see check_integrity
+					continue
+				delta = sum(new_cost) - (sum(old_cost) if old_cost is not None else 0)
+				if not delta:
+					continue
+					
+				changes.append({'product_code': code,
+								'old_cost': old_cost,
+								'new_cost': new_cost,
+								'delta': delta,
+								'causes': self._change_causes(old, new, material_prices, 
+															   activity_prices, rate_changes)})
+			return changes
+			
+		finally:
+			if old_connection is not None:
+				old_connection.close()
+			new_connection.close()
+			
+	def _change_causes(self, old, new, material_prices, activity_prices, rate_changes):
+		"""Returns the price, exchange rate and bill changes that affect a product
+		between its old and new versions (old is None for new products)."""
+		
+		new_kernel = new.kernel if new.kernel is not None else new.buildKernel()
+		if old is None:
+			return [{'type': 'new_product'}]
+		old_kernel = old.kernel if old.kernel is not None else old.buildKernel()
+		
+		causes = []
+		for cause, prices, codes in (('material_price', material_prices, new_kernel[0]),
+									 ('activity_price', activity_prices, 
+									  new_kernel[2] + new_kernel[4])):
+			for code in codes:
+				if code in prices:
+					old_price, new_price, old_currency, new_currency = prices[code]
+					causes.append({'type': cause, 'code': code, 
+								   'old': old_price, 'new': new_price,
+								   'old_currency': old_currency, 'new_currency': new_currency})
+		
+		if rate_changes:
+			materials, activities = new._catalogues()
+			currencies = set(materials[code].currency for code in new_kernel[0]
+							 if code in materials)
+			currencies.update(activities[code].currency for code in new_kernel[2] + new_kernel[4]
+							  if code in activities)
+			for currency in sorted(currencies):
+				if currency in rate_changes:
+					causes.append({'type': 'fx_rate', 'currency': currency,
+								   'old': rate_changes[currency][0], 
+								   'new': rate_changes[currency][1]})
+		
+		# kernels hold (codes, coefficients) pairs for materials, activities and setups
+		for bill, position in (('bill_of_materials', 0), ('bill_of_activities', 2), 
+							   ('setup_activities', 4)):
+			old_lines = dict(zip(old_kernel[position], old_kernel[position + 1]))
+			new_lines = dict(zip(new_kernel[position], new_kernel[position + 1]))
+			for code in set(old_lines) | set(new_lines):
+				if old_lines.get(code) != new_lines.get(code):
+					causes.append({'type': bill, 'code': code,
+								   'old': old_lines.get(code), 'new': new_lines.get(code)})
+		return causes
+		
+	def calculate_costs(self, currency = BASE_CURRENCY, rate_date = None):
+		"""Yields the product code, material cost and activity cost of every product
+		in the catalogue, in currency at the exchange rates of rate_date (the latest
+		by default), for lots of one unit as Product.CalculateCost. The costs of all
+		the products are the product of the requirements matrix (built through scan,
+		so the memory budget mode is honoured) by the converted prices; the products
+		whose bills cannot be compiled are left out (see requirements_matrix). Without
+		numpy and scipy each product is costed on its own, through cost_cache."""
+		
+		if sparse is None:
+			# the exchange rates are looked up once for all the products
+			factors = FxTrax.conversion_factors(self.root.get('fx_rates'), currency, rate_date)
+			for code, product in self.scan(self.products):
+				try:
+					material_cost, activity_cost = cost_cache.get(product, factors = factors)
+				except ZeroDivisionError:
+					continue
+				yield code, material_cost, activity_cost
+			return
+			
+		requirements = self.requirements_matrix()
+		prices = self._prices(requirements, currency, rate_date)
+		material_count = len(requirements['materials'])
+		
+		matrix = requirements['matrix']
+		material_costs = matrix[:material_count].T.dot(prices[:material_count])
+		activity_costs = (matrix[material_count:].T.dot(prices[material_count:]) + 
+						  requirements['setup'].T.dot(prices[material_count:]))
+		
+		for code, material_cost, activity_cost in zip(requirements['products'], 
+													  material_costs, activity_costs):
+			yield code, float(material_cost), float(activity_cost)
+			
+	def compile_kernels(self, batch_size = 1000):
+		"""Compiles the kernel of every product in the catalogue, needed once for the
+		products saved before the kernels were introduced. Commits every batch_size
+		products. Returns the number of products compiled."""
+		
+		count = 0
+		for code, product in self.scan(self.products, batch_size):
+			product.compileKernel()
+			count += 1
+			if count % batch_size == 0:
+				self.commit()
+		self.commit()
+		return count
+			
+	def check_integrity(self, batch_size = None):
+		"""Checks the bills of materials and activities of every product and yields a
+		dictionary for each problem found:
+			product_code: product with the problem.
+			bill: 'materials' or 'activities'.
+			component_code: code of the material or activity of the line.
+			problem: one of
+				dangling_code: the material or activity does not exist.
+				wrong_consumption: consumption is missing or not a number.
+				zero_ratio: production ratio is 0, missing or not a number, the cost
+					cannot be calculated.
+				waste_out_of_range: waste is missing or not a number between 0 and 100.
+				unit_mismatch: consumption unit differs from the material base unit or
+					the activity unit.
+			detail: description of the problem.
+		The products are read in batches of batch_size (scan_batch_size or 1000 by
+		default) and the cache is emptied between them, so catalogues of any size
+		can be checked."""
+		
+		if batch_size is None:
+			batch_size = Trax.scan_batch_size or 1000
+			
+		materials = MaterialTrax().materials
+		activities = ActivityTrax().activities
+		
+		def issue(product_code, bill, component_code, problem, detail):
+			return {'product_code': product_code, 'bill': bill, 
+					'component_code': component_code, 'problem': problem, 'detail': detail}
+					
+		for code, product in self.scan(self.products, batch_size):
+			for material_code, material in product.bill_of_materials.items():
+				consumption = material.get("consumption")
+				if not is_number(consumption):
+					yield issue(code, 'materials', material_code, 'wrong_consumption',
+								"Consumption is %r" % (consumption,))
+				
+				ratio = material.get("production_ratio")
+				if not is_number(ratio) or not float(ratio):
+					yield issue(code, 'materials', material_code, 'zero_ratio',
+								"Production ratio is %r" % (ratio,))
+				
+				waste = material.get("waste")
+				if not is_number(waste) or not 0 <= float(waste) <= 100:
+					yield issue(code, 'materials', material_code, 'waste_out_of_range',
+								"Waste is %r" % (waste,))
+				
+				if material_code not in materials:
+					yield issue(code, 'materials', material_code, 'dangling_code',
+								"Material code does not exist")
+				elif (str(material.get("consumption_unit")).strip().lower() != 
+					  str(materials[material_code].base_unit).strip().lower()):
+					yield issue(code, 'materials', material_code, 'unit_mismatch',
+								"Consumption unit %r, material base unit %r" 
+								% (material.get("consumption_unit"), materials[material_code].base_unit))
+								
+			for activity_code, activity in product.bill_of_activities.items():
+				consumption = activity.get("consumption")
+				if not is_number(consumption):
+					yield issue(code, 'activities', activity_code, 'wrong_consumption',
+								"Consumption is %r" % (consumption,))
+				
+				ratio = activity.get("production_ratio")
+				if not is_number(ratio) or not float(ratio):
+					yield issue(code, 'activities', activity_code, 'zero_ratio',
+								"Production ratio is %r" % (ratio,))
+				
+				if activity_code not in activities:
+					yield issue(code, 'activities', activity_code, 'dangling_code',
+								"Activity code does not exist")
+				elif (str(activity.get("activity_unit")).strip().lower() != 
+					  str(activities[activity_code].activity_unit).strip().lower()):
+					yield issue(code, 'activities', activity_code, 'unit_mismatch',
+								"Activity unit %r, activity unit in catalogue %r" 
+								% (activity.get("activity_unit"), activities[activity_code].activity_unit))
+		
+	def requirements_matrix(self):
+		"""Returns the coefficients needed to explode a production plan. The matrix
+		is reused while the connection sees the same database state (see _snapshot),
+		so any change committed by this or other objects, threads or processes
+		builds it again. It is not reused while there are changes not committed yet.
+		Returns a dictionary with:
+			matrix: sparse CSR matrix with a row for each material followed by a row for
+				each activity and a column for each product. Each value is the amount of
+				material or activity needed to make one unit of the product.
+			setup: sparse CSR matrix with a row for each activity and a column for each
+				product. Each value is the amount of activity needed to set up one lot.
+			products: product codes in column order.
+			materials: material codes in row order.
+			activities: activity codes in row order, after the materials.
+			errors: {product code: error} for the products left out because their
+				bills cannot be compiled (a production ratio of 0).
+		BOM lines pointing to a material or activity that no longer exists are ignored.
+		"""
+		
+		snapshot = self._snapshot()
+		if (self._requirements is not None and snapshot is not None and 
+			snapshot == self._requirements_snapshot):
+			return self._requirements
+			
+		if sparse is None:
+			raise ImportError("numpy and scipy are needed to explode production plans")
+			
+		materials = MaterialTrax().materials
+		activities = ActivityTrax().activities
+		
+		product_codes = []
+		material_codes = list(materials.keys())
+		activity_codes = list(activities.keys())
+		
+		# activities rows are placed after the materials rows
+		material_rows = dict((code, row) for row, code in enumerate(material_codes))
+		activity_rows = dict((code, row + len(material_codes)) 
+							for row, code in enumerate(activity_codes))
+		
+		rows = []
+		columns = []
+		coefficients = []
+		# setup activities are kept apart as they are consumed per lot
+		setup_rows = []
+		setup_columns = []
+		setup_coefficients = []
+		errors = {}
+		
+		for code, product in self.scan(self.products):
+			# same coefficients used by Product.CalculateCost
+			kernel = product.kernel
+			if kernel is None:
+				try:
+					kernel = product.buildKernel()
+				except ZeroDivisionError:
+					errors[code] = "A bill line has a production ratio of 0."
+					continue
+			column = len(product_codes)
+			product_codes.append(code)
+			(product_materials, product_material_coefficients, 
+			 product_activities, product_activity_coefficients,
+			 product_setups, product_setup_coefficients) = kernel
+			
+			for material_code, coefficient in zip(product_materials, product_material_coefficients):
+				if material_code in material_rows:
+					rows.append(material_rows[material_code])
+					columns.append(column)
+					coefficients.append(coefficient)
+									 
+			for activity_code, coefficient in zip(product_activities, product_activity_coefficients):
+				if activity_code in activity_rows:
+					rows.append(activity_rows[activity_code])
+					columns.append(column)
+					coefficients.append(coefficient)
+					
+			for activity_code, coefficient in zip(product_setups, product_setup_coefficients):
+				if activity_code in activity_rows:
+					setup_rows.append(activity_rows[activity_code] - len(material_codes))
+					setup_columns.append(column)
+					setup_coefficients.append(coefficient)
+		
+		matrix = sparse.csr_matrix( (coefficients, (rows, columns)),
+									shape = (len(material_codes) + len(activity_codes),
+											 len(product_codes)) )
+		setup = sparse.csr_matrix( (setup_coefficients, (setup_rows, setup_columns)),
+								   shape = (len(activity_codes), len(product_codes)) )
+		
+		self._requirements = {'matrix': matrix,
+							  'setup': setup,
+							  'products': product_codes,
+							  'materials': material_codes,
+							  'activities': activity_codes,
+							  'product_columns': dict((code, column) 
+									for column, code in enumerate(product_codes)),
+							  'errors': errors}
+		self._requirements_snapshot = snapshot
+		return self._requirements
+		
+	def explode(self, demand, currency = BASE_CURRENCY, rate_date = None):
+		"""Calculates the total materials and activities needed to fulfill a production
+		plan and its cost.
+		Parameters:
+		demand: dictionary with the product code as key and the quantity to be made as value.
+		Returns a dictionary with:
+			materials: {material code: {'quantity': amount needed, 'unit': base unit}}
+			activities: {activity code: {'quantity': amount needed, 'unit': activity unit}}
+			material_cost: total cost of the materials.
+			activity_cost: total cost of the activities.
+			errors: {product code: error} for the demand lines that have been ignored.
+		Each product in the plan is made in a single lot, so its setup activities are
+		counted once. The costs are in currency, at the exchange rates of rate_date
+		(the latest by default).
+		"""
+		
+		requirements = self.requirements_matrix()
+		columns = requirements['product_columns']
+		
+		plan = numpy.zeros(len(requirements['products']))
+		errors = {}
+		
+		for code, quantity in demand.items():
+			if code not in columns:
+				errors[code] = requirements['errors'].get(code, "Product code does not exist.")
+			elif not is_number(quantity):
+				errors[code] = "Quantity must be a number"
+			else:
+				plan[columns[code]] += float(quantity)
+				
+		return self._explode_plan(requirements, plan, errors, currency, rate_date)
+		
+	def explode_file(self, path, chunk_size = 10000, delimiter = ",",
+					 currency = BASE_CURRENCY, rate_date = None):
+		"""Same as explode but the production plan is read from a CSV file with a
+		product code and a quantity in each line. The same product can appear in many
+		lines (i.e. one line per order). The file is read in chunks of chunk_size lines
+		so its size is not limited by the available memory."""
+		
+		requirements = self.requirements_matrix()
+		columns = requirements['product_columns']
+		
+		plan = numpy.zeros(len(requirements['products']))
+		errors = {}
+		
+		with open(path, "rb") as orders:
+			reader = csv.reader(orders, delimiter = delimiter)
+			while True:
+				chunk_columns = []
+				chunk_quantities = []
+				for line in reader:
+					if len(line) < 2:
+						continue
+					code, quantity = line[0].strip(), line[1].strip()
+					# product codes are integers when entered through the menu
+					if code.isdigit():
+						code = int(code)
+					if code not in columns:
+						errors[code] = requirements['errors'].get(code, 
+													"Product code does not exist.")
+					elif not is_number(quantity):
+						errors[code] = "Quantity must be a number"
+					else:
+						chunk_columns.append(columns[code])
+						chunk_quantities.append(float(quantity))
+					if len(chunk_columns) >= chunk_size:
+						break
+				
+				if not chunk_columns:
+					break
+					
+				plan += numpy.bincount(chunk_columns, weights = chunk_quantities,
+									   minlength = len(plan))
+		
+		return self._explode_plan(requirements, plan, errors, currency, rate_date)
+		
+	def _explode_plan(self, requirements, plan, errors, currency, rate_date):
+		"""Multiplies the coefficient matrix by the plan vector and translates the
+		result into material and activity codes."""
+		
+		material_count = len(requirements['materials'])
+		
+		totals = requirements['matrix'].dot(plan)
+		# one lot for each product in the plan
+		totals[material_count:] += requirements['setup'].dot((plan > 0) * 1.0)
+		
+		materials = MaterialTrax().materials
+		activities = ActivityTrax().activities
+		
+		prices = self._prices(requirements, currency, rate_date)
+		costs = prices * totals
+		
+		result = {'materials': {}, 'activities': {}, 
+				  'material_cost': costs[:material_count].sum(),
+				  'activity_cost': costs[material_count:].sum(),
+				  'errors': errors}
+		
+		for code, quantity in zip(requirements['materials'], totals[:material_count]):
+			if quantity:
+				result['materials'][code] = {'quantity': quantity, 
+											 'unit': materials[code].base_unit}
+				
+		for code, quantity in zip(requirements['activities'], totals[material_count:]):
+			if quantity:
+				result['activities'][code] = {'quantity': quantity, 
+											  'unit': activities[code].activity_unit}
+		
+		return result
+		
+	def _prices(self, requirements, currency = BASE_CURRENCY, rate_date = None):
+		"""Returns an array with the current cost per unit of the materials and
+		activities in the rows order of the requirements matrix, converted to
+		currency at the exchange rates of rate_date (the latest by default)."""
+		
+		materials = MaterialTrax().materials
+		activities = ActivityTrax().activities
+		
+		components = ([materials[code] for code in requirements['materials']] +
+					  [activities[code] for code in requirements['activities']])
+		
+		prices = numpy.array([component.cost_per_unit for component in components], dtype = float)
+		if not components:
+			return prices
+		
+		# every price is multiplied by the factor of its currency in one operation
+		currencies, positions = numpy.unique(
+			numpy.array([str(component.currency) for component in components]),
+			return_inverse = True)
+		factors = FxTrax.conversion_factors(self.root.get('fx_rates'), currency, rate_date)
+		missing = [name for name in currencies if name not in factors]
+		if missing:
+			raise ValueError("No exchange rate for %s" % ", ".join(missing))
+			
+		return prices * numpy.array([factors[name] for name in currencies])[positions]
+		
+	def lot_size_curves(self, lot_sizes, product_codes = None, currency = BASE_CURRENCY,
+						rate_date = None):
+		"""Calculates the unit cost of the products for several lot sizes at once. The
+		setup activities cost is divided by the lot size, the rest of the cost is the
+		same for every lot size.
+		Parameters:
+		lot_sizes: sequence of lot sizes (units of F.P. per lot), all greater than 0.
+		product_codes: products to include. All the catalogue by default.
+		currency, rate_date: currency of the costs and date of the exchange rates
+			(the latest by default).
+		Returns a dictionary with:
+			products: product codes in rows order.
+			lot_sizes: array with the lot sizes in columns order.
+			unit_costs: array with a row for each product and a column for each lot size.
+			errors: {product code: error} for the products left out, see 
+				requirements_matrix.
+		"""
+		
+		lot_sizes = numpy.asarray(lot_sizes, dtype = float).ravel()
+		if (lot_sizes <= 0).any():
+			raise ValueError("Lot sizes must be greater than 0")
+			
+		requirements = self.requirements_matrix()
+		prices = self._prices(requirements, currency, rate_date)
+		
+		# cost per unit that does not depend on the lot size and setup cost per lot
+		variable_cost = requirements['matrix'].T.dot(prices)
+		setup_cost = requirements['setup'].T.dot(prices[len(requirements['materials']):])
+		
+		products = requirements['products']
+		errors = requirements['errors']
+		if product_codes is not None:
+			errors = dict((code, errors[code]) for code in product_codes if code in errors)
+			products = [code for code in product_codes if code not in errors]
+			columns = requirements['product_columns']
+			selection = [columns[code] for code in products]
+			variable_cost = variable_cost[selection]
+			setup_cost = setup_cost[selection]
+		
+		unit_costs = variable_cost[:, numpy.newaxis] + setup_cost[:, numpy.newaxis] / lot_sizes
+		
+		return {'products': products, 'lot_sizes': lot_sizes, 'unit_costs': unit_costs,
+				'errors': dict(errors)}
+		
+	def cost_drivers(self, n = 20, by = 'material', demand = None, product_codes = None,
+					 lot_size = 1, currency = BASE_CURRENCY, rate_date = None):
+		"""Returns the n biggest contributors to the cost of the catalogue. The cost
+		of every BOM line of every product is calculated at once from the
+		requirements matrix and the current prices, and the biggest ones are
+		selected with a heap. The products whose bills cannot be compiled are left
+		out (see requirements_matrix).
+		Parameters:
+		by: how the line costs are grouped:
+			material / activity: total cost of each material or activity.
+			product: cost of each product.
+			line: each BOM line on its own.
+		demand: {product code: quantity} to weight each product cost. Without it
+			the cost of one unit of each product is used. Products not in the
+			catalogue are ignored.
+		product_codes: only these products are taken into account.
+		lot_size: units per lot used to share the setup activities cost.
+		currency, rate_date: currency of the costs and date of the exchange rates
+			(the latest by default).
+		Returns a list, most important first, of dictionaries with:
+			code: material, activity or product code (for lines, the component code).
+			cost: its cost.
+			share: part of the total cost of the products taken into account.
+			product_code, kind: product and 'material' or 'activity', only for lines.
+		"""
+		
+		if by not in ('material', 'activity', 'product', 'line'):
+			raise ValueError("Cost drivers can be grouped by material, activity, product or line")
+		
+		requirements = self.requirements_matrix()
+		columns = requirements['product_columns']
+		material_count = len(requirements['materials'])
+		
+		# amount of each component per unit of product, setup activities included
+		setup = requirements['setup'] / float(lot_size)
+		amounts = requirements['matrix'] + sparse.vstack(
+					[sparse.csr_matrix((material_count, len(columns))), setup]).tocsr()
+		
+		# weight of each product
+		if demand is None:
+			weights = numpy.ones(len(columns))
+		else:
+			weights = numpy.zeros(len(columns))
+			for code, quantity in demand.items():
+				if code in columns:
+					weights[columns[code]] += float(quantity)
+		if product_codes is not None:
+			selected = numpy.zeros(len(columns))
+			selected[[columns[code] for code in product_codes if code in columns]] = 1
+			weights *= selected
 			
+		# cost of each line: component price x amount x product weight
+		prices = self._prices(requirements, currency, rate_date)
+		lines = sparse.diags(prices).dot(amounts).dot(sparse.diags(weights)).tocoo()
+		total = lines.sum()
+		
+		if by == 'product':
+			costs = numpy.asarray(lines.sum(axis = 0)).ravel()
+			keys = requirements['products']
+		elif by == 'material':
+			costs = numpy.asarray(lines.sum(axis = 1)).ravel()[:material_count]
+			keys = requirements['materials']
+		elif by == 'activity':
+			costs = numpy.asarray(lines.sum(axis = 1)).ravel()[material_count:]
+			keys = requirements['activities']
+		else:
+			costs = lines.data
+			keys = None
 			
+		top = heapq.nlargest(n, xrange(len(costs)), key = costs.__getitem__)
+		
+		drivers = []
+		for position in top:
+			if not costs[position]:
+				break
+			driver = {'cost': costs[position],
+					  'share': costs[position] / total if total else 0.0}
+			if keys is not None:
+				driver['code'] = keys[position]
+			else:
+				row = lines.row[position]
+				driver['product_code'] = requirements['products'][lines.col[position]]
+				if row < material_count:
+					driver.update(kind = 'material', code = requirements['materials'][row])
+				else:
+					driver.update(kind = 'activity', 
+								  code = requirements['activities'][row - material_count])
+			drivers.append(driver)
+		return drivers
+			
+			
+	def cost_variances(self, path, chunk_size = 100000, compress = None,
+					   currency = BASE_CURRENCY, rate_date = None):
+		"""Compares the actual consumption logged for the production orders with the
+		standards of the bills of materials and activities. The log is a CSV file
+		with a header line or a JSON Lines file (.jsonl, .json), gzip compressed or
+		not (see open_file), with a row for each component used by an order:
+			product_code: product made.
+			kind: material or activity.
+			component_code: material or activity code.
+			produced: units of F.P. made by the order.
+			quantity: amount of the component consumed, waste included.
+			waste: amount of the material wasted (0 if not given).
+			price: actual cost per unit, in the currency of the component. When it
+				is not given the standard cost per unit is used.
+		Each component must be logged once per order (the produced units are added
+		per component) and each order is a lot for the setup activities.
+		The log is read in chunks of chunk_size rows, grouped with numpy, so only
+		the totals of each product and component are kept in memory.
+		Variances are in currency at the exchange rates of rate_date (the latest by
+		default), positive when the actual cost is higher than the standard:
+			price variance = (actual price - standard price) x actual quantity
+			usage variance = (actual net quantity - standard net quantity) x standard price
+			waste variance = (actual waste - standard waste) x standard price
+		Returns a dictionary with:
+			components: a dictionary for each product and component with its codes,
+				produced, actual and standard quantity, actual and standard cost and the
+				price, usage, waste and total variances.
+			products: {product code: {'price', 'usage', 'waste', 'total'}} variances.
+			rejected: number of rows that could not be used.
+			errors: {row number: error} of the first 1000 rows rejected, and
+				{(product code, kind, component code): error} for the products and
+				components not in the catalogues, whose standard price is taken as 0.
+		The bill lines of the products logged without any consumption are included
+		too, with an actual quantity of 0. Raises ValueError if the currency of a
+		component has no exchange rate.
+		"""
+		
+		if numpy is None:
+			raise ImportError("numpy is needed to calculate the cost variances")
+		
+		# group number of each (product code, kind, component code)
+		groups = {}
+		keys = []
+		# totals by group: produced, quantity, waste, cost of the priced quantity,
+		# quantity without price and number of orders
+		totals = numpy.zeros((6, 0))
+		errors = {}
+		rejected = 0
+		
+		rows = self._log_rows(path, compress)
+		while True:
+			chunk = list(itertools.islice(rows, chunk_size))
+			if not chunk:
+				break
+				
+			numbers = []
+			values = []
+			for number, row in chunk:
+				try:
+					key, value = self._log_values(row)
+				except (KeyError, ValueError, TypeError, AttributeError) as error:
+					rejected += 1
+					if len(errors) < 1000:
+						errors[number] = "Wrong row: %s" % error
+					continue
+				group = groups.get(key)
+				if group is None:
+					group = groups[key] = len(keys)
+					keys.append(key)
+				numbers.append(group)
+				values.append(value)
+				
+			if not numbers:
+				continue
+			if len(keys) > totals.shape[1]:
+				totals = numpy.hstack([totals, numpy.zeros((6, len(keys) - totals.shape[1]))])
+			values = numpy.array(values)
+			for column in range(6):
+				totals[column] += numpy.bincount(numbers, weights = values[:, column],
+												 minlength = len(keys))
+		
+		# the bill lines of the products logged that were not consumed have a
+		# standard too, for the units and orders of the product: the largest of
+		# the totals of its logged components
+		product_totals = {}
+		for group, (product_code, kind, component_code) in enumerate(keys):
+			made, lots = product_totals.get(product_code, (0.0, 0.0))
+			product_totals[product_code] = (max(made, totals[0, group]), 
+											 max(lots, totals[5, group]))
+		unlogged = []
+		for product_code, (made, lots) in product_totals.items():
+			product = self.products.get(product_code)
+			if product is None:
+				continue
+			for kind, bill in (('material', product.bill_of_materials), 
+							   ('activity', product.bill_of_activities)):
+				for component_code in bill.keys():
+					key = (product_code, kind, component_code)
+					if key not in groups:
+						groups[key] = len(keys)
+						keys.append(key)
+						unlogged.append((made, 0.0, 0.0, 0.0, 0.0, lots))
+		if unlogged:
+			totals = numpy.hstack([totals, numpy.array(unlogged).T])
+		
+		produced, quantity, waste, priced_cost, unpriced, orders = totals
+		
+		# standards of each group
+		materials = MaterialTrax().materials
+		activities = ActivityTrax().activities
+		factors = FxTrax.conversion_factors(self.root.get('fx_rates'), currency, rate_date)
+		
+		count = len(keys)
+		net_ratio = numpy.zeros(count)
+		waste_ratio = numpy.zeros(count)
+		per_lot = numpy.zeros(count, dtype = bool)
+		standard_price = numpy.zeros(count)
+		factor = numpy.ones(count)
+		missing_rates = set()
+		
+		for group, key in enumerate(keys):
+			product_code, kind, component_code = key
+			product = self.products.get(product_code)
+			if product is None:
+				errors[key] = "Product code does not exist."
+			elif kind == 'material':
+				line = product.bill_of_materials.get(component_code)
+				if line is not None:
+					net_ratio[group] = line["consumption"] / line["production_ratio"]
+					waste_ratio[group] = line["waste"] / 100
+			else:
+				line = product.bill_of_activities.get(component_code)
+				if line is not None:
+					net_ratio[group] = line["consumption"] / line["production_ratio"]
+					per_lot[group] = bool(line.get("setup"))
+					
+			if kind == 'material':
+				component = materials.get(component_code)
+			else:
+				component = activities.get(component_code)
+			if component is None:
+				errors.setdefault(key, "%s code does not exist." % kind.capitalize())
+			elif component.currency not in factors:
+				missing_rates.add(component.currency)
+			else:
+				factor[group] = factors[component.currency]
+				standard_price[group] = component.cost_per_unit * factor[group]
+				
+		if missing_rates:
+			raise ValueError("No exchange rate for %s" % ", ".join(sorted(missing_rates)))
+		
+		# the components without price were bought at the standard price
+		actual_cost = priced_cost * factor + unpriced * standard_price
+		standard_net = numpy.where(per_lot, orders, produced) * net_ratio
+		standard_waste = standard_net * waste_ratio
+		standard_quantity = standard_net + standard_waste
+		
+		price_variance = actual_cost - quantity * standard_price
+		usage_variance = (quantity - waste - standard_net) * standard_price
+		waste_variance = (waste - standard_waste) * standard_price
+		total_variance = price_variance + usage_variance + waste_variance
+		
+		components = []
+		by_product = {}
+		for group, (product_code, kind, component_code) in enumerate(keys):
+			components.append({'product_code': product_code,
+							   'kind': kind,
+							   'component_code': component_code,
+							   'produced': produced[group],
+							   'actual_quantity': quantity[group],
+							   'standard_quantity': standard_quantity[group],
+							   'actual_cost': actual_cost[group],
+							   'standard_cost': standard_quantity[group] * standard_price[group],
+							   'price_variance': price_variance[group],
+							   'usage_variance': usage_variance[group],
+							   'waste_variance': waste_variance[group],
+							   'total_variance': total_variance[group]})
+			
+			product = by_product.setdefault(product_code, 
+							{'price': 0.0, 'usage': 0.0, 'waste': 0.0, 'total': 0.0})
+			product['price'] += price_variance[group]
+			product['usage'] += usage_variance[group]
+			product['waste'] += waste_variance[group]
+			product['total'] += total_variance[group]
+		
+		return {'components': components, 'products': by_product,
+				'rejected': rejected, 'errors': errors}
+				
+	def _log_rows(self, path, compress = None):
+		"""Yields the row number and a dictionary for each row of a production log."""
+		
+		name = path[:-3] if path.endswith(".gz") else path
+		with open_file(path, "r", compress) as log:
+			if name.endswith((".jsonl", ".json")):
+				for number, line in enumerate(log, 1):
+					if line.strip():
+						try:
+							yield number, json.loads(line)
+						except ValueError:
+							yield number, None
+			else:
+				for number, row in enumerate(csv.DictReader(log), 2):
+					yield number, row
+					
+	def _log_values(self, row):
+		"""Returns the group key and the values to add of a production log row."""
+		
+		def code(value):
+			# codes are integers when entered through the menu
+			value = str(value).strip()
+			return int(value) if value.isdigit() else value
+			
+		if not isinstance(row, dict):
+			raise ValueError("row is not a JSON object")
+			
+		kind = str(row['kind']).strip().lower()
+		if kind not in ('material', 'activity'):
+			raise ValueError("kind must be material or activity")
+			
+		produced = float(row['produced'])
+		quantity = float(row['quantity'])
+		waste = float(row.get('waste') or 0) if kind == 'material' else 0.0
+		price = row.get('price')
+		
+		if price is None or str(price).strip() == "":
+			priced_cost, unpriced = 0.0, quantity
+		else:
+			priced_cost, unpriced = float(price) * quantity, 0.0
+		
+		key = (code(row['product_code']), kind, code(row['component_code']))
+		return key, (produced, quantity, waste, priced_cost, unpriced, 1.0)
+		
+		
 class MaterialTrax(Trax):
 	"""Models the Company's material catalogue. If the database
 	material's dictionary hasn't been created it creates it otherwise
 	loads the data from the database."""
 		
 	def __init__(self, intro = "Material trax  tracking helper",
-			 db_path="products.fs"):
+			 db_path="products.fs", autocommit = True):
 				 
-		Trax.__init__(self)
-		if 'materials' in self.root:
-			self.materials = self.root['materials']
-		else:
-			self.materials = self.root['materials'] = PersistentDict()
+		Trax.__init__(self, intro, db_path, autocommit)
+		self.materials = self._catalogue('materials')
 		
 		
-	def addMaterial(self, code, name, description, cost_per_unit, base_unit):
+	@retry_on_conflict
+	def addMaterial(self, code, name, description, cost_per_unit, base_unit,
+					currency = BASE_CURRENCY):
 		"""Adds a new material to the catalogue. If the material already exists
 		or any of the parameters do not meet the requirements returns False and an error dictionary.
-		If all parameters are right returns True and an empty errors dictionary"""
+		If all parameters are right returns True and an empty errors dictionary.
+		The cost per unit is in currency, a three letters code (EUR, USD, GBP...)."""
 		errors = {}
 		information_is_valid = True
 		if is_number(code):
@@ -452,11 +2238,16 @@ class MaterialTrax(Trax):
 			information_is_valid = False
 						
 				
+		currency = str(currency or BASE_CURRENCY).strip().upper()
+		if len(currency) != 3 or not currency.isalpha():
+			errors['wrong_currency'] = "Currency must be a three letters code"
+			information_is_valid = False
+				
 		if information_is_valid:
 		
-			material = Material( code, name, description, cost_per_unit, base_unit)
+			material = Material( code, name, description, cost_per_unit, base_unit, currency)
 			self.materials[code] = material
-			transaction.commit()
+			self._commit()
 			return True, errors
 			
 		return False, errors
@@ -472,19 +2263,19 @@ class MaterialTrax(Trax):
 class ActivityTrax(Trax):
 		
 	def __init__(self, intro = "Material trax  tracking helper",
-			 db_path="products.fs"):
+			 db_path="products.fs", autocommit = True):
 				 
-		Trax.__init__(self)
-		if 'activities' in self.root:
-			self.activities = self.root['activities']
-		else:
-			self.activities = self.root['activities'] = PersistentDict()
+		Trax.__init__(self, intro, db_path, autocommit)
+		self.activities = self._catalogue('activities')
 		
 		
-	def addActivity(self, code, name, description, cost_per_unit, activity_unit):
+	@retry_on_conflict
+	def addActivity(self, code, name, description, cost_per_unit, activity_unit,
+					currency = BASE_CURRENCY):
 		"""Adds a new activity to the catalogue. If the activity already exists
 		or any of the parameters do not meet the requirements returns False and an error dictionary.
-		If all parameters are right returns True and an empty errors dictionary"""
+		If all parameters are right returns True and an empty errors dictionary.
+		The cost per unit is in currency, a three letters code (EUR, USD, GBP...)."""
 		errors = {}
 		information_is_valid = True
 		if is_number(code):
@@ -502,10 +2293,15 @@ class ActivityTrax(Trax):
 			errors['wrong_cost_per_unit'] = "Cost per unit must be a number"
 			information_is_valid = False
 						
+		currency = str(currency or BASE_CURRENCY).strip().upper()
+		if len(currency) != 3 or not currency.isalpha():
+			errors['wrong_currency'] = "Currency must be a three letters code"
+			information_is_valid = False
+			
 		if information_is_valid:
-			activity = Activity( code, name, description, cost_per_unit, activity_unit)
+			activity = Activity( code, name, description, cost_per_unit, activity_unit, currency)
 			self.activities[code] = activity		
-			transaction.commit()
+			self._commit()
 			return True, errors
 			
 		return False, errors
@@ -520,6 +2316,478 @@ class ActivityTrax(Trax):
 
 		return self.activities[activity_code]
 		
+class FxTrax(Trax):
+	"""Models the exchange rates table. For each currency it keeps the rates by
+	date: the value in BASE_CURRENCY of one unit of the currency from that date
+	on. Dates are saved as ISO strings (YYYY-MM-DD)."""
+	
+	def __init__(self, intro = "Exchange rates tracking helper",
+			 db_path="products.fs", autocommit = True):
+				 
+		Trax.__init__(self, intro, db_path, autocommit)
+		self.rates = self._catalogue('fx_rates')
+		
+	@staticmethod
+	def date_key(rate_date):
+		"""Returns the key of a date (a date, datetime or YYYY-MM-DD string) in the
+		table, always zero padded so the keys sort by date. Raises ValueError if the
+		string is not a valid date."""
+		
+		if rate_date is None:
+			return None
+		if isinstance(rate_date, (datetime.date, datetime.datetime)):
+			return rate_date.isoformat()[:10]
+		return datetime.datetime.strptime(str(rate_date).strip()[:10], 
+										  "%Y-%m-%d").date().isoformat()
+		
+	@retry_on_conflict
+	def addRate(self, currency, rate_date, rate):
+		"""Adds the exchange rate of a currency from a date on. Returns True and an
+		empty errors dictionary, or False and the errors found."""
+		
+		errors = {}
+		information_is_valid = True
+		
+		currency = str(currency).strip().upper()
+		if len(currency) != 3 or not currency.isalpha():
+			errors['wrong_currency'] = "Currency must be a three letters code"
+			information_is_valid = False
+		elif currency == BASE_CURRENCY:
+			errors['base_currency'] = "The rate of %s is always 1" % BASE_CURRENCY
+			information_is_valid = False
+			
+		try:
+			rate_date = FxTrax.date_key(rate_date)
+		except (TypeError, ValueError):
+			rate_date = None
+		if rate_date is None:
+			errors['wrong_date'] = "Date must be a date or a YYYY-MM-DD string"
+			information_is_valid = False
+			
+		if is_number(rate) and float(rate) > 0:
+			rate = float(rate)
+		else:
+			errors['wrong_rate'] = "Rate must be a number greater than 0"
+			information_is_valid = False
+			
+		if information_is_valid:
+			if currency not in self.rates:
+				self.rates[currency] = OOBTree()
+			self.rates[currency][rate_date] = rate
+			self._commit()
+			return True, errors
+			
+		return False, errors
+		
+	def search(self, currency, rate_date = None):
+		"""Returns the exchange rate of a currency at a date (the latest by default)
+		or False if there is not any."""
+		
+		factors = FxTrax.conversion_factors(self.rates, BASE_CURRENCY, rate_date)
+		return factors.get(str(currency).upper(), False)
+		
+	def factors(self, currency = BASE_CURRENCY, rate_date = None):
+		"""Returns {currency: factor} to convert the costs in each currency to the
+		currency given, at the rates of rate_date (the latest by default)."""
+		
+		return FxTrax.conversion_factors(self.rates, currency, rate_date)
+		
+	@staticmethod
+	def conversion_factors(rates, currency = BASE_CURRENCY, rate_date = None):
+		"""Same as factors for a given rates table, which may be None. Currencies
+		without a rate at rate_date are left out. Raises ValueError if currency
+		does not have one or rate_date is not a valid date."""
+		
+		# the codes are saved in upper case by addRate
+		currency = str(currency).strip().upper()
+		rate_date = FxTrax.date_key(rate_date)
+		
+		def rate(name):
+			if name == BASE_CURRENCY:
+				return 1.0
+			history = rates.get(name) if rates is not None else None
+			if not history:
+				return None
+			try:
+				return history[history.maxKey(rate_date) if rate_date else history.maxKey()]
+			except ValueError:
+				# no rate at that date
+				return None
+				
+		reporting_rate = rate(currency)
+		if reporting_rate is None:
+			raise ValueError("No exchange rate for %s" % currency)
+		
+		factors = {BASE_CURRENCY: 1.0 / reporting_rate}
+		for name in (rates.keys() if rates is not None else ()):
+			name_rate = rate(name)
+			if name_rate is not None:
+				factors[name] = name_rate / reporting_rate
+		return factors
+		
+def _stress_writer(first, operations, results, zeo_address = None):
+	"""Writer used by stress_writers: adds operations materials starting at code
+	first and puts in results the number added, whether it was stopped by a
+	conflict, and the conflicts and retries counted in its process."""
+	
+	if zeo_address is not None:
+		Trax.conflicts = Trax.retries = 0
+		Trax.open(zeo_address = zeo_address)
+		
+	materials = MaterialTrax()
+	added = 0
+	failed = False
+	try:
+		for code in range(first, first + operations):
+			materials.addMaterial(code, "Stress %s" % code, "Stress test material",
+								  1, "unidad")
+			added += 1
+	except ConflictError:
+		failed = True
+	finally:
+		Trax.release()
+		
+	if zeo_address is not None:
+		Trax.close()
+		results.put((added, failed, Trax.conflicts, Trax.retries))
+	else:
+		# the counters are shared with the other threads
+		results.put((added, failed, 0, 0))
+
+def stress_writers(writer_counts = (1, 2, 4, 8), operations = 100, zeo_address = None):
+	"""Measures the write throughput when several writers add materials at the
+	same time. Each writer adds operations materials with its own codes, 
+	committing each one. It writes in the database opened (a scratch one should be
+	used) and the materials catalogue must be an OOBTree (see
+	Trax.migrate_catalogues).
+	Without zeo_address each writer is a thread with its own connection to the
+	database opened. With the address of a ZEO server each writer is a separate
+	process connected to it; the database of the calling process is closed and
+	opened again on the same server.
+	Returns a list with a dictionary for each number of writers: writers,
+	operations (materials added), seconds, throughput (commits per second),
+	conflicts, retries and failed (writers stopped by a conflict after all the
+	retries)."""
+	
+	if zeo_address is not None:
+		Trax.open(zeo_address = zeo_address)
+	materials = MaterialTrax().materials
+	first_code = materials.maxKey() + 1 if len(materials) else 1
+	Trax.release()
+	if zeo_address is not None:
+		# the writer processes open their own connection to the server
+		Trax.close()
+	
+	results = []
+	for writers in writer_counts:
+		Trax.conflicts = Trax.retries = 0
+		
+		if zeo_address is None:
+			queue = Queue.Queue()
+			worker = threading.Thread
+		else:
+			queue = multiprocessing.Queue()
+			worker = multiprocessing.Process
+			
+		workers = [worker(target = _stress_writer, 
+						  args = (first_code + writer * operations, operations, queue, zeo_address))
+				   for writer in range(writers)]
+		
+		start = time.time()
+		for writer in workers:
+			writer.start()
+		done = [queue.get() for writer in workers]
+		seconds = time.time() - start
+		for writer in workers:
+			writer.join()
+		
+		added = sum(result[0] for result in done)
+		first_code += writers * operations
+		results.append({'writers': writers,
+						'operations': added,
+						'seconds': seconds,
+						'throughput': added / seconds,
+						'conflicts': Trax.conflicts + sum(result[2] for result in done),
+						'retries': Trax.retries + sum(result[3] for result in done),
+						'failed': sum(1 for result in done if result[1])})
+	
+	if zeo_address is not None:
+		Trax.open(zeo_address = zeo_address)
+	
+	return results
+
+class CostRequestHandler(SocketServer.StreamRequestHandler):
+	"""Reads JSON requests, one per line, and writes a JSON response line for each
+	one. A line may hold a list of requests (a batch), answered with a list of
+	responses in the same order.
+	Requests:
+		{"op": "cost", "product": code, "lot_size": 1, "currency": "EUR", "rate_date": null}
+		{"op": "cost", "products": [code, ...], "lot_size": 1, ...}
+		{"op": "material", "code": code}
+		{"op": "activity", "code": code}
+		{"op": "where_used", "material": code} or {"op": "where_used", "activity": code}
+		{"op": "metrics"}
+	Responses have "ok" true and the data requested, or "ok" false and an "error".
+	"""
+	
+	def handle(self):
+		
+		for line in self.rfile:
+			if not line.strip():
+				continue
+			try:
+				requests = json.loads(line)
+			except ValueError:
+				response = {'ok': False, 'error': "Request is not valid JSON"}
+			else:
+				# each line is answered with the data committed when it arrives
+				transaction.abort()
+				if isinstance(requests, list):
+					response = [self.server.answer(request) for request in requests]
+				else:
+					response = self.server.answer(requests)
+			self.wfile.write(json.dumps(response) + "\n")
+			self.wfile.flush()
+			
+			
+class CostServer(SocketServer.UnixStreamServer):
+	"""Long running costing service listening on a Unix domain socket. It keeps
+	the database and the caches open between requests. The connections accepted
+	are served by a fixed number of worker threads, each one with its own
+	database connection; when all of them are busy new connections wait in a
+	queue of queue_size. Use serve_forever to run it and server_close to stop it.
+	A socket left at socket_path by a previous run is replaced; any other file
+	there raises OSError."""
+	
+	def __init__(self, socket_path, workers = 4, queue_size = 64):
+		
+		if os.path.lexists(socket_path):
+			if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+				raise OSError(errno.EEXIST, "File exists and is not a socket", socket_path)
+			os.unlink(socket_path)
+		SocketServer.UnixStreamServer.__init__(self, socket_path, CostRequestHandler)
+		
+		self.socket_path = socket_path
+		self.started = time.time()
+		self.metrics = {'requests': 0, 'errors': 0,
+						'latency_total': 0.0, 'latency_max': 0.0}
+		self._metrics_lock = threading.Lock()
+		
+		# Trax objects of each worker thread
+		self._local = threading.local()
+		
+		self._pending = Queue.Queue(queue_size)
+		self._workers = [threading.Thread(target = self._work) for worker in range(workers)]
+		for worker in self._workers:
+			worker.daemon = True
+			worker.start()
+			
+	def process_request(self, request, client_address):
+		"""Leaves the connection for the workers instead of serving it."""
+		
+		self._pending.put((request, client_address))
+		
+	def _work(self):
+		
+		while True:
+			pending = self._pending.get()
+			if pending is None:
+				break
+			request, client_address = pending
+			try:
+				self.finish_request(request, client_address)
+			except Exception:
+				self.handle_error(request, client_address)
+			finally:
+				self.shutdown_request(request)
+				
+		Trax.release()
+		
+	def server_close(self):
+		
+		SocketServer.UnixStreamServer.server_close(self)
+		for worker in self._workers:
+			self._pending.put(None)
+		for worker in self._workers:
+			worker.join()
+		if os.path.exists(self.socket_path):
+			os.unlink(self.socket_path)
+			
+	def catalogues(self):
+		"""Returns the ProductTrax, MaterialTrax and ActivityTrax of the current
+		worker thread."""
+		
+		local = self._local
+		if getattr(local, 'db', None) is not Trax.db:
+			local.db = Trax.db
+			local.products = ProductTrax()
+			local.materials = MaterialTrax()
+			local.activities = ActivityTrax()
+		return local.products, local.materials, local.activities
+		
+	def answer(self, request):
+		"""Returns the response to a request, updating the metrics."""
+		
+		start = time.time()
+		try:
+			response = self._answer(request)
+		except Exception as error:
+			response = {'ok': False, 'error': "%s: %s" % (error.__class__.__name__, error)}
+		latency = time.time() - start
+		
+		with self._metrics_lock:
+			self.metrics['requests'] += 1
+			self.metrics['latency_total'] += latency
+			self.metrics['latency_max'] = max(self.metrics['latency_max'], latency)
+			if not response.get('ok'):
+				self.metrics['errors'] += 1
+				
+		return response
+		
+	def _answer(self, request):
+		
+		products, materials, activities = self.catalogues()
+		op = request.get('op')
+		
+		if op == 'cost':
+			lot_size = request.get('lot_size', 1)
+			factors = FxTrax.conversion_factors(products.root.get('fx_rates'), 
+												request.get('currency', BASE_CURRENCY),
+												request.get('rate_date'))
+			codes = request['products'] if 'products' in request else [request['product']]
+			costs = []
+			for code in codes:
+				product = products.search(code)
+				if product is False:
+					costs.append({'product': code, 'error': "Product code does not exist."})
+					continue
+				material_cost, activity_cost = cost_cache.get(product, lot_size, factors)
+				costs.append({'product': code,
+							  'material_cost': material_cost,
+							  'activity_cost': activity_cost,
+							  'total_cost': material_cost + activity_cost})
+			if 'products' in request:
+				return {'ok': True, 'costs': costs}
+			if 'error' in costs[0]:
+				return {'ok': False, 'error': costs[0]['error']}
+			response = costs[0]
+			response['ok'] = True
+			return response
+			
+		if op == 'material':
+			material = materials.search(request['code'])
+			if material is False:
+				return {'ok': False, 'error': "Material code does not exist."}
+			return {'ok': True, 'code': material.code, 'name': material.name,
+					'description': material.description, 
+					'cost_per_unit': material.cost_per_unit, 'currency': material.currency,
+					'base_unit': material.base_unit}
+					
+		if op == 'activity':
+			activity = activities.search(request['code'])
+			if activity is False:
+				return {'ok': False, 'error': "Activity code does not exist."}
+			return {'ok': True, 'code': activity.code, 'name': activity.name,
+					'description': activity.description, 
+					'cost_per_unit': activity.cost_per_unit, 'currency': activity.currency,
+					'activity_unit': activity.activity_unit}
+					
+		if op == 'where_used':
+			if 'material' in request:
+				return {'ok': True, 'products': products.where_used(material_code = request['material'])}
+			return {'ok': True, 'products': products.where_used(activity_code = request['activity'])}
+			
+		if op == 'metrics':
+			return dict(self.report(), ok = True)
+			
+		return {'ok': False, 'error': "Unknown operation: %s" % op}
+		
+	def report(self):
+		"""Returns the service metrics: requests answered, errors, connections
+		waiting, mean and maximum latency in seconds, throughput (requests per
+		second since the server started) and the cost cache statistics."""
+		
+		with self._metrics_lock:
+			metrics = dict(self.metrics)
+		uptime = time.time() - self.started
+		requests = metrics.pop('requests')
+		latency_total = metrics.pop('latency_total')
+		
+		metrics.update({'requests': requests,
+						'waiting': self._pending.qsize(),
+						'uptime': uptime,
+						'latency_mean': latency_total / requests if requests else 0.0,
+						'throughput': requests / uptime if uptime else 0.0,
+						'cost_cache': cost_cache.stats()})
+		return metrics
+		
+		
+class CostClient(object):
+	"""Client of CostServer. request sends a request (or a list of them) and
+	returns the response."""
+	
+	def __init__(self, socket_path):
+		
+		self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		self.socket.connect(socket_path)
+		self.file = self.socket.makefile("rwb")
+		
+	def request(self, request):
+		
+		self.file.write(json.dumps(request) + "\n")
+		self.file.flush()
+		return json.loads(self.file.readline())
+		
+	def close(self):
+		
+		self.file.close()
+		self.socket.close()
+		
+		
+def load_test(socket_path, product_codes, requests = 1000, clients = 4, batch = 1):
+	"""Measures a running CostServer: clients threads, each one with its own
+	connection, send requests cost requests for the given products, batch
+	requests per line. Returns a dictionary with requests, seconds, throughput 
+	(requests per second), errors and the mean, median, 95th percentile and
+	maximum latency of each line in seconds."""
+	
+	latencies = []
+	errors = []
+	
+	def client(count):
+		connection = CostClient(socket_path)
+		try:
+			for first in range(0, count, batch):
+				line = [{'op': 'cost', 'product': product_codes[(first + i) % len(product_codes)]}
+						for i in range(min(batch, count - first))]
+				start = time.time()
+				responses = connection.request(line)
+				latencies.append(time.time() - start)
+				errors.extend(response for response in responses if not response['ok'])
+		finally:
+			connection.close()
+			
+	threads = [threading.Thread(target = client, args = (requests // clients,))
+			   for number in range(clients)]
+	
+	start = time.time()
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	seconds = time.time() - start
+	
+	latencies.sort()
+	sent = (requests // clients) * clients
+	return {'requests': sent,
+			'seconds': seconds,
+			'throughput': sent / seconds,
+			'errors': len(errors),
+			'latency_mean': sum(latencies) / len(latencies) if latencies else 0.0,
+			'latency_median': latencies[len(latencies) // 2] if latencies else 0.0,
+			'latency_p95': latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+			'latency_max': latencies[-1] if latencies else 0.0}
+		
 class Product_Menu:
 
 	'''Display a menu respond to choices when run. '''
@@ -562,7 +2830,7 @@ class Product_Menu:
 				
 	def show_products(self, products = None):
 		if not products:
-			for code, product in self.products.products.items():
+			for code, product in self.products.scan(self.products.products):
 				print product
 					
 	def search_product(self):
@@ -748,7 +3016,7 @@ class Material_Menu:
 				
 	def show_materials(self, materials = None):
 		if not materials:
-			for code, material in self.materials.materials.items():
+			for code, material in self.materials.scan(self.materials.materials):
 				print material
 					
 	def search_material(self):
@@ -828,7 +3096,7 @@ class Activity_Menu:
 				
 	def show_activities(self, activities = None):
 		if not activities:
-			for code, activity in self.activities.activities.items():
+			for code, activity in self.activities.scan(self.activities.activities):
 				print activity
 					
 	def search_activity(self):